@@ -1,16 +1,20 @@
 #! /usr/bin/env python3
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 import argparse
 import functools
-import glob
 import inspect
 import json
+import mmap
 import os
 import re
 import shutil
 import signal
+import stat
+import struct
 import subprocess
 import sys
+import threading
 
 signal.signal(signal.SIGINT,  signal.SIG_DFL)
 
@@ -26,95 +30,329 @@ QtModule = namedtuple('QtModule', 'name lib')
 QtPlugin = namedtuple('QtPlugin', 'name path')
 QtTranslation = namedtuple('QtTranslation', 'name path')
 QmlModule = namedtuple('QmlModule', 'name path relative_path lib')
+ElfFile = namedtuple('ElfFile', 'elf_class machine needed rpath runpath')
+
+_LIB_RE = re.compile(r'^lib(\S+)\.so[.0-9]*$')
+_PRI_RE = re.compile(r'^\s*QT\.[a-zA-Z]+\.(\S+)\s*=\s*(.*)')
+_LD_SO_RE = re.compile(r'^ld(64)?([-.][\w.-]*)?\.so[.0-9]*$')
+_PATCHELF_VERSION_RE = re.compile(r'^patchelf\s+(\d+)\.(\d+)')
+
+_QT_TR_MAP = {
+    'Qt6Concurrent': 'qtbase',
+    'Qt6Core': 'qtbase',
+    'Qt6Declarative': 'qtquick1',
+    'Qt6Gui': 'qtbase',
+    'Qt6Help': 'qt_help',
+    'Qt6Multimedia': 'qtmultimedia',
+    'Qt6MultimediaWidgets': 'qtmultimedia',
+    'Qt6MultimediaQuick': 'qtmultimedia',
+    'Qt6Network': 'qtbase',
+    'Qt6Qml': 'qtdeclarative',
+    'Qt6Quick': 'qtdeclarative',
+    'Qt6Script': 'qtscript',
+    'Qt6ScriptTools': 'qtscript',
+    'Qt6SerialPort': 'qtserialport',
+    'Qt6Sql': 'qtbase',
+    'Qt6Test': 'qtbase',
+    'Qt6Widgets': 'qtbase',
+    'Qt6Xml': 'qtbase',
+    'Qt6WebEngine': 'qtwebengine',
+}
 
 def memoize(function):
-    cache = {}
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            return tuple(function(*args))
 
-    @functools.wraps(function)
-    def wrapper(*args):
-        if args not in cache:
-            result = function(*args)
-            if inspect.isgenerator(result):
-                result = list(result)
-            cache[args] = result
-        return cache[args]
+        return functools.lru_cache(maxsize=None)(wrapper)
 
-    return wrapper
+    return functools.lru_cache(maxsize=None)(function)
 
 def log_fatal(msg):
-    print('ERROR: '+msg, file=sys.stderr)
+    sys.stderr.write('ERROR: ' + msg + '\n')
     exit(1)
 
 def log_normal(msg):
     global op_mode
     if op_mode.verbosity >= 1:
-        print(msg, file=sys.stderr)
+        sys.stderr.write(msg + '\n')
 
 def log_verbose(msg):
     global op_mode
     if op_mode.verbosity >= 2:
-        print(msg, file=sys.stderr)
+        sys.stderr.write(msg + '\n')
 
 @memoize
-def resolve_libs(executable):
-    if not shutil.which('ldd'):
-        log_fatal("cannot find 'ldd' tool in PATH")
+def cached_realpath(path):
+    return os.path.realpath(path)
+
+@memoize
+def read_elf(path):
+    return load_elf(path)
+
+def load_elf(path):
+    try:
+        with open(path, 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    with data:
+        try:
+            return parse_elf(data)
+        except struct.error:
+            return None
+
+def parse_elf(data):
+    if data[:4] != b'\x7fELF':
+        return None
+
+    elf_class = data[4]
+    byte_order = '<' if data[5] == 1 else '>'
+
+    if elf_class == 1:
+        phoff_fmt, phdr_fmt, dyn_fmt = 'I', 'IIIIIIII', 'iI'
+        phoff_pos, phnum_pos = 28, 42
+    elif elf_class == 2:
+        phoff_fmt, phdr_fmt, dyn_fmt = 'Q', 'IIQQQQQQ', 'qQ'
+        phoff_pos, phnum_pos = 32, 54
+    else:
+        return None
 
-    output = subprocess.check_output(['ldd', '-r', executable])
-    output = output.decode()
-    output = output.split('\n')
+    machine, = struct.unpack_from(byte_order+'H', data, 18)
+    phoff, = struct.unpack_from(byte_order+phoff_fmt, data, phoff_pos)
+    phentsize, phnum = struct.unpack_from(byte_order+'HH', data, phnum_pos)
 
-    for line in output:
-        m = re.match(r'^\s*(\S+\.so[.0-9]*)\s*=>\s*(/\S+)', line)
-        if m:
-            lib_name = m.group(1)
-            lib_path = m.group(2)
+    load_list = []
+    dynamic = None
 
-            if os.path.isfile(lib_path):
-                yield SharedLib(lib_name, os.path.realpath(lib_path))
+    for n in range(phnum):
+        fields = struct.unpack_from(byte_order+phdr_fmt, data, phoff + n*phentsize)
+        if elf_class == 1:
+            p_type, p_offset, p_vaddr, _, p_filesz = fields[:5]
+        else:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = fields[:6]
+
+        if p_type == 1: # PT_LOAD
+            load_list.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == 2: # PT_DYNAMIC
+            dynamic = (p_offset, p_filesz)
+
+    needed_list, rpath_list, runpath_list = [], [], []
+
+    if dynamic:
+        dyn_size = struct.calcsize(byte_order+dyn_fmt)
+        strtab = None
+        entries = []
+
+        for pos in range(dynamic[0], dynamic[0] + dynamic[1], dyn_size):
+            tag, val = struct.unpack_from(byte_order+dyn_fmt, data, pos)
+            if tag == 0: # DT_NULL
+                break
+            if tag == 5: # DT_STRTAB
+                for vaddr, offset, filesz in load_list:
+                    if vaddr <= val < vaddr + filesz:
+                        strtab = val - vaddr + offset
+            else:
+                entries.append((tag, val))
+
+        if strtab is not None:
+            for tag, val in entries:
+                if tag in (1, 15, 29): # DT_NEEDED, DT_RPATH, DT_RUNPATH
+                    end = data.find(b'\0', strtab + val)
+                    string = data[strtab + val:end].decode(errors='replace')
+
+                    if tag == 1:
+                        needed_list.append(string)
+                    elif tag == 15:
+                        rpath_list += string.split(':')
+                    else:
+                        runpath_list += string.split(':')
+
+    return ElfFile(elf_class, machine, needed_list, rpath_list, runpath_list)
 
-def find_libs(*path_list):
-    unique_path_list = set()
+@memoize
+def read_ld_cache():
+    cache_map = {}
+
+    try:
+        with open('/etc/ld.so.cache', 'rb') as fp:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return cache_map
+
+    with data:
+        base = data.find(b'glibc-ld.so.cache1.1')
+        if base < 0:
+            return cache_map
+
+        try:
+            nlibs, = struct.unpack_from('=I', data, base + 20)
+
+            for n in range(nlibs):
+                _, key, value, _, _ = struct.unpack_from('=iIIIQ', data, base + 48 + n*24)
+
+                lib_name = data[base + key:data.find(b'\0', base + key)].decode()
+                lib_path = data[base + value:data.find(b'\0', base + value)].decode()
 
+                cache_map.setdefault(lib_name, []).append(lib_path)
+        except (struct.error, UnicodeDecodeError):
+            pass
+
+    return cache_map
+
+def expand_search_path(path_list, origin):
+    for path in path_list:
+        if path:
+            yield path.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+
+def find_needed_lib(elf, lib_name, search_dirs):
+    if '/' in lib_name:
+        candidate_list = [lib_name]
+    else:
+        candidate_list = [os.path.join(d, lib_name) for d in search_dirs]
+        candidate_list += read_ld_cache().get(lib_name, [])
+        candidate_list += [os.path.join(d, lib_name) for d in
+                           ['/lib64', '/usr/lib64', '/lib', '/usr/lib']]
+
+    for lib_path in candidate_list:
+        lib_elf = read_elf(lib_path)
+        if lib_elf and lib_elf.elf_class == elf.elf_class and lib_elf.machine == elf.machine:
+            return lib_path
+
+def transitive_libs(path_list):
     for path in path_list:
-        if not os.path.realpath(path) in [os.path.realpath(p) for p in unique_path_list]:
-            unique_path_list.add(path)
+        if not read_elf(path):
+            log_fatal("cannot read ELF file: %s" % path)
+
+    env_dirs = os.environ.get('LD_LIBRARY_PATH', '').split(':')
+
+    loaded_names = set()
+    loaded_paths = set(cached_realpath(path) for path in path_list)
+
+    # like ld.so, use resolved path for $ORIGIN of executables, and the
+    # path where library was found (without resolving symlinks) for libraries
+    queue = deque(
+        (path, os.path.dirname(cached_realpath(path)), []) for path in path_list)
+
+    while queue:
+        path, origin, parent_rpath = queue.popleft()
+        elf = read_elf(path)
+
+        rpath = list(expand_search_path(elf.rpath, origin)) + parent_rpath
+        search_dirs = (rpath if not elf.runpath else []) + \
+            list(expand_search_path(env_dirs, origin)) + \
+            list(expand_search_path(elf.runpath, origin))
+
+        for lib_name in elf.needed:
+            if lib_name in loaded_names or _LD_SO_RE.match(lib_name):
+                continue
+
+            lib_path = find_needed_lib(elf, lib_name, search_dirs)
+            if not lib_path:
+                continue
+            loaded_names.add(lib_name)
+
+            lib_realpath = cached_realpath(lib_path)
+            if lib_realpath in loaded_paths:
+                continue
+            loaded_paths.add(lib_realpath)
+
+            yield SharedLib(lib_name, lib_realpath)
+
+            queue.append(
+                (lib_path, os.path.dirname(os.path.abspath(lib_path)), rpath))
+
+@memoize
+def resolve_libs(executable):
+    return tuple(transitive_libs([executable]))
+
+def find_qt_libs(qtdir, path_list):
+    for lib in transitive_libs(path_list):
+        if is_qt_lib(qtdir, lib):
+            yield lib
+
+def scan_dir(path):
+    try:
+        with os.scandir(path) as entries:
+            yield from entries
+    except OSError:
+        pass
+
+def find_libs(*path_list):
+    unique_path_list = {cached_realpath(p): p for p in path_list}.values()
 
     for path in unique_path_list:
-        for root, dirs, files in os.walk(path):
-            for file_name in files:
-                if parse_lib_name(file_name):
-                    yield SharedLib(file_name, os.path.join(root, file_name))
+        dir_stack = [path]
+
+        while dir_stack:
+            for entry in scan_dir(dir_stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    dir_stack.append(entry.path)
+                elif parse_lib_name(entry.name) and not entry.is_dir():
+                    yield SharedLib(entry.name, entry.path)
 
 def parse_lib_name(file_name):
-    m = re.match(r'^lib(\S+)\.so[.0-9]*$', file_name)
+    m = _LIB_RE.match(file_name)
     if m:
         return m.group(1)
 
 def format_lib_name(lib_name):
     return 'lib' + lib_name + '.so'
 
-def set_runpath(executable, rpath):
+def has_runpath(elf, rpath):
+    return elf is not None and not elf.rpath and ':'.join(elf.runpath) == rpath
+
+def patchelf_version():
+    proc = subprocess.run(
+        ['patchelf', '--version'],
+        text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    m = _PATCHELF_VERSION_RE.match(proc.stdout)
+    if m:
+        return (int(m.group(1)), int(m.group(2)))
+
+    return (0, 0)
+
+def set_runpath(executable_list, rpath):
     if not os.path.isabs(rpath):
         if rpath == '.':
             rpath = '$ORIGIN'
         else:
             rpath = os.path.join('$ORIGIN', rpath)
 
-    if not shutil.which('patchelf'):
-        log_fatal("cannot find 'patchelf' tool in PATH")
+    # skip files that already have the requested run path; re-read them
+    # instead of using read_elf() cache, since they were just deployed
+    executable_list = [
+        e for e in executable_list if not has_runpath(load_elf(e), rpath)]
+    if not executable_list:
+        return
 
-    subprocess.run([
-        'patchelf',
-        '--set-rpath', rpath,
-        executable,
-        ],
-        check=True, stdout=subprocess.DEVNULL)
+    def run_patchelf(file_list):
+        subprocess.run([
+            'patchelf',
+            '--set-rpath', rpath,
+            *file_list,
+            ],
+            check=True, stdout=subprocess.DEVNULL)
+
+    # patchelf >= 0.10 accepts multiple files; older versions silently
+    # use only one of them, so run one process per file instead
+    global patchelf_multi_file
+    if patchelf_multi_file:
+        run_patchelf(executable_list)
+        return
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(
+            lambda executable: run_patchelf([executable]),
+            executable_list))
 
 @memoize
 def is_qt_lib(qtdir, lib):
-    lib_path = os.path.realpath(lib.path)
-    base_path = os.path.realpath(os.path.join(qtdir, 'lib'))
+    lib_path = cached_realpath(lib.path)
+    base_path = cached_realpath(os.path.join(qtdir, 'lib'))
 
     if not parse_lib_name(os.path.basename(lib_path)):
         return False
@@ -132,12 +370,18 @@ def avail_qt_modules(qtdir):
     modules_dir = os.path.join(qtdir, 'mkspecs', 'modules')
     module_map = {}
 
-    for pri_file in glob.glob(os.path.join(modules_dir, '*.pri')):
-        with open(pri_file) as fp:
+    for entry in scan_dir(modules_dir):
+        if not entry.name.endswith('.pri') or not entry.is_file():
+            continue
+
+        with open(entry.path) as fp:
             module = {}
 
-            for line in fp.readlines():
-                m = re.match(r'^\s*QT\.[a-zA-Z]+\.(\S+)\s*=\s*(.*)', line)
+            for line in fp:
+                if 'QT.' not in line:
+                    continue
+
+                m = _PRI_RE.match(line)
                 if m:
                     module[m.group(1)] = m.group(2)
 
@@ -147,37 +391,19 @@ def avail_qt_modules(qtdir):
     return module_map
 
 @memoize
-def avail_qt_langs(qtdir):
+def avail_qt_translation_files(qtdir):
     trans_dir = os.path.join(qtdir, 'translations')
 
-    for tr_file in glob.glob(os.path.join(trans_dir, 'qtbase_*.qm')):
-        m = re.match(r'^qtbase_(\S+).qm$', os.path.basename(tr_file))
-        if m:
-            yield m.group(1)
+    return frozenset(
+        entry.name for entry in scan_dir(trans_dir) if entry.is_file())
 
 @memoize
-def avail_qt_translations():
-    return {
-        'Qt6Concurrent': 'qtbase',
-        'Qt6Core': 'qtbase',
-        'Qt6Declarative': 'qtquick1',
-        'Qt6Gui': 'qtbase',
-        'Qt6Help': 'qt_help',
-        'Qt6Multimedia': 'qtmultimedia',
-        'Qt6MultimediaWidgets': 'qtmultimedia',
-        'Qt6MultimediaQuick': 'qtmultimedia',
-        'Qt6Network': 'qtbase',
-        'Qt6Qml': 'qtdeclarative',
-        'Qt6Quick': 'qtdeclarative',
-        'Qt6Script': 'qtscript',
-        'Qt6ScriptTools': 'qtscript',
-        'Qt6SerialPort': 'qtserialport',
-        'Qt6Sql': 'qtbase',
-        'Qt6Test': 'qtbase',
-        'Qt6Widgets': 'qtbase',
-        'Qt6Xml': 'qtbase',
-        'Qt6WebEngine': 'qtwebengine',
-    }
+def avail_qt_langs(qtdir):
+    for file_name in sorted(avail_qt_translation_files(qtdir)):
+        if file_name.startswith('qtbase_') and file_name.endswith('.qm'):
+            lang_name = file_name[len('qtbase_'):-len('.qm')]
+            if lang_name:
+                yield lang_name
 
 @memoize
 def find_qt_modules(qtdir, executable):
@@ -194,31 +420,22 @@ def find_qt_module_executables(qtdir, module):
             'QtWebEngineProcess',
             os.path.join(qtdir, 'libexec', 'QtWebEngineProcess'))
 
-@memoize
-def find_qt_module_libs(qtdir, module):
-    yield module.lib
-
-    for lib in resolve_libs(module.lib.path):
-        if is_qt_lib(qtdir, lib):
-            yield lib
-
 @memoize
 def find_qt_module_translations(qtdir, module):
-    lang_list = avail_qt_langs(qtdir)
-    tr_map = avail_qt_translations()
+    trans_dir = os.path.join(qtdir, 'translations')
+    trans_files = avail_qt_translation_files(qtdir)
 
-    if module.name in tr_map:
-        for lang_name in lang_list:
-            tr_file = os.path.join(qtdir, 'translations', '%s_%s.qm' % (
-                tr_map[module.name], lang_name))
+    if module.name in _QT_TR_MAP:
+        for lang_name in avail_qt_langs(qtdir):
+            tr_name = '%s_%s.qm' % (_QT_TR_MAP[module.name], lang_name)
 
-            if os.path.isfile(tr_file):
-                yield QtTranslation(os.path.basename(tr_file), tr_file)
+            if tr_name in trans_files:
+                yield QtTranslation(tr_name, os.path.join(trans_dir, tr_name))
 
     if is_webengine_module(module):
         yield QtTranslation(
             'qtwebengine_locales',
-            os.path.join(qtdir, 'translations', 'qtwebengine_locales'))
+            os.path.join(trans_dir, 'qtwebengine_locales'))
 
 @memoize
 def find_qt_module_plugins(qtdir, module):
@@ -233,22 +450,23 @@ def find_qt_module_plugins(qtdir, module):
                     yield QtPlugin(plugin_name, plugin_path)
 
 @memoize
-def find_qt_plugin_libs(qtdir, plugin):
-    libs = set()
-
-    for plugin_lib in find_libs(plugin.path):
-        for lib in resolve_libs(plugin_lib.path):
-            if is_qt_lib(qtdir, lib):
-                libs.add(lib)
+def find_qt_plugin_libs(plugin):
+    if not os.path.isdir(plugin.path):
+        return ()
 
-    return libs
+    return tuple(sorted(set(
+        cached_realpath(plugin_lib.path) for plugin_lib in find_libs(plugin.path))))
 
 @memoize
-def find_qml_modules(qtdir, qmldir):
+def find_qml_modules(qtdir, qmldir_list):
+    root_args = []
+    for qmldir in qmldir_list:
+        root_args += ['-rootPath', qmldir]
+
     proc = subprocess.run(
         [os.path.join(qtdir, 'libexec', 'qmlimportscanner'),
          '-importPath', os.path.join(qtdir, 'qml'),
-         '-rootPath', qmldir],
+         *root_args],
         check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
 
     js = json.loads(proc.stdout)
@@ -274,62 +492,134 @@ def find_qml_modules(qtdir, qmldir):
         yield QmlModule(
             qml_import['name'], qml_import['path'], relative_path, lib)
 
-@memoize
-def find_qml_module_libs(qtdir, qml_module):
-    if qml_module.lib:
-        for lib in resolve_libs(qml_module.lib.path):
-            if is_qt_lib(qtdir, lib):
-                yield lib
+created_dirs = set()
+
+def prepare_destination(dst):
+    try:
+        st = os.lstat(dst)
+    except FileNotFoundError:
+        st = None
+
+    if st is None:
+        parent_dir = os.path.dirname(dst)
+        if parent_dir not in created_dirs:
+            os.makedirs(parent_dir, exist_ok=True)
+            created_dirs.add(parent_dir)
+        return
+
+    global op_mode
+    if not op_mode.force:
+        log_fatal("cannot overwrite without -force: %s" % dst)
+
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(dst, ignore_errors=True)
+        created_dirs.difference_update(
+            [d for d in list(created_dirs) if d == dst or d.startswith(dst+os.sep)])
+    else:
+        os.unlink(dst)
+
+def fast_copy(src, dst):
+    # copy_file_range() copies data inside the kernel and can make
+    # reflinks on copy-on-write filesystems; it's not available on
+    # older kernels and pythons, and doesn't work across some filesystems
+    # also, some kernels and filesystems return 0 (as if EOF was reached)
+    # for files they can't handle, so check how much was actually copied
+    with open(src, 'rb', buffering=0) as src_fp, open(dst, 'wb', buffering=0) as dst_fp:
+        src_size = os.fstat(src_fp.fileno()).st_size
+        copied_size = 0
+
+        try:
+            while True:
+                size = os.copy_file_range(src_fp.fileno(), dst_fp.fileno(), 1 << 30)
+                if size <= 0:
+                    break
+                copied_size += size
+        except (AttributeError, OSError):
+            copied_size = 0
+
+        if copied_size == 0 or copied_size < src_size:
+            src_fp.seek(0)
+            dst_fp.seek(0)
+            dst_fp.truncate()
+            shutil.copyfileobj(src_fp, dst_fp)
+
+    shutil.copystat(src, dst)
+    return dst
+
+def replace_file(src, dst):
+    # remove existing file instead of writing into it, because it may be
+    # read-only or share its inode with another file via a hardlink
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    except IsADirectoryError:
+        shutil.rmtree(dst)
+
+    return fast_copy(src, dst)
 
 def copy_directory(src, dst, ignore=None):
     global op_mode
     if op_mode.dry_run:
         return
-    if not op_mode.force:
-        if os.path.exists(dst):
-            log_fatal("cannot overwrite without -force: %s" % dst)
 
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    if os.path.isfile(dst):
-        os.unlink(dst)
-    elif os.path.isdir(dst):
-        shutil.rmtree(dst, ignore_errors=True)
+    # existing directory is removed, so that files left from previous
+    # deployment (e.g. stale plugins) are not shipped
+    prepare_destination(dst)
 
-    shutil.copytree(src, dst, ignore=ignore)
+    shutil.copytree(
+        src, dst, ignore=ignore, dirs_exist_ok=True, copy_function=replace_file)
 
 def copy_file(src, dst):
     global op_mode
     if op_mode.dry_run:
         return
-    if not op_mode.force:
-        if os.path.exists(dst):
-            log_fatal("cannot overwrite without -force: %s" % dst)
 
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    if os.path.isfile(dst):
-        os.unlink(dst)
-    elif os.path.isdir(dst):
-        shutil.rmtree(dst, ignore_errors=True)
+    prepare_destination(dst)
 
-    shutil.copy2(src, dst)
+    fast_copy(src, dst)
 
 def write_file(dst, content):
     global op_mode
     if op_mode.dry_run:
         return
-    if not op_mode.force:
-        if os.path.exists(dst):
-            log_fatal("cannot overwrite without -force: %s" % dst)
 
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    if os.path.isfile(dst):
-        os.unlink(dst)
-    elif os.path.isdir(dst):
-        shutil.rmtree(dst, ignore_errors=True)
+    prepare_destination(dst)
 
     with open(dst, 'w') as fp:
         fp.write(content)
 
+def deploy_parallel(deploy_function, dirs, item_list, group_key):
+    # items of the same group share installation path (or its prefix),
+    # so they are deployed sequentially, and groups are deployed in parallel
+    group_map = {}
+    for item in sorted(item_list):
+        group_map.setdefault(group_key(item), []).append(item)
+
+    # on first failure (e.g. log_fatal), don't start deploying other items
+    failed = threading.Event()
+
+    def deploy_group(group):
+        for item in group:
+            if failed.is_set():
+                return
+            try:
+                deploy_function(dirs, item)
+            except BaseException:
+                failed.set()
+                raise
+
+    executor = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1)*4))
+    try:
+        future_list = [executor.submit(deploy_group, group)
+                       for group in group_map.values()]
+        done, _ = wait(future_list, return_when=FIRST_EXCEPTION)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    for future in done:
+        future.result()
+
 def deploy_exe(dirs, exe):
     inst_path = os.path.join(dirs.exe_dir, exe.name)
     if os.path.realpath(exe.path) == os.path.realpath(inst_path):
@@ -392,16 +682,21 @@ Translations = {translations_dir}
     data_dir=os.path.relpath(dirs.data_dir, dirs.exe_dir),
     translations_dir=os.path.relpath(dirs.translations_dir, dirs.exe_dir)))
 
-def update_deployed_runpath(dirs, file_path):
-    log_verbose('Updating run path of %s' % file_path)
+def update_deployed_runpath(dirs, file_list):
+    rpath_map = {}
+
+    for file_path in file_list:
+        log_verbose('Updating run path of %s' % file_path)
+
+        rpath = os.path.relpath(dirs.lib_dir, os.path.dirname(file_path))
+        rpath_map.setdefault(rpath, []).append(file_path)
 
     global op_mode
     if op_mode.dry_run:
         return
 
-    set_runpath(
-        file_path,
-        os.path.relpath(dirs.lib_dir, os.path.dirname(file_path)))
+    for rpath, path_list in sorted(rpath_map.items()):
+        set_runpath(path_list, rpath)
 
 parser = argparse.ArgumentParser(
     description="Unofficial tool to make Linux Qt6 applications self-contained.",
@@ -496,23 +791,31 @@ all_qt_translations = set()
 all_qt_plugins = set()
 all_qml_modules = set()
 
-all_libs = set()
-all_executables = set()
+all_libs = {}
+all_executables = {}
+
+# libraries, plugins and qml plugins whose dependencies should be deployed
+lib_dep_paths = []
 
 for executable in args.executable:
     log_normal('Scanning dependencies of %s ...' % executable)
 
-    all_executables.add(
-        Executable(os.path.basename(executable), executable))
+    exe = Executable(os.path.basename(executable), executable)
+    if exe.name in all_executables:
+        other_path = all_executables[exe.name].path
+        if cached_realpath(other_path) != cached_realpath(exe.path):
+            log_fatal("cannot deploy executables with same name: %s and %s" % (
+                other_path, exe.path))
+    all_executables.setdefault(exe.name, exe)
 
     for qt_module in find_qt_modules(args.qtdir, executable):
         all_qt_modules.add(qt_module)
 
         for exe in find_qt_module_executables(args.qtdir, qt_module):
-            all_executables.add(exe)
+            all_executables.setdefault(exe.name, exe)
 
-        for lib in find_qt_module_libs(args.qtdir, qt_module):
-            all_libs.add(lib)
+        all_libs.setdefault(qt_module.lib.name, qt_module.lib)
+        lib_dep_paths.append(qt_module.lib.path)
 
         for tr in find_qt_module_translations(args.qtdir, qt_module):
             all_qt_translations.add(tr)
@@ -521,17 +824,28 @@ for executable in args.executable:
             if not qt_plugin in all_qt_plugins:
                 all_qt_plugins.add(qt_plugin)
 
-                for lib in find_qt_plugin_libs(args.qtdir, qt_plugin):
-                    all_libs.add(lib)
+                lib_dep_paths += find_qt_plugin_libs(qt_plugin)
 
-for qmlscandir in (args.qmlscandir or []):
-    log_normal('Scanning qml imports of %s ...' % qmlscandir)
+if args.qmlscandir:
+    for qmlscandir in args.qmlscandir:
+        log_normal('Scanning qml imports of %s ...' % qmlscandir)
 
-    for qml_module in find_qml_modules(args.qtdir, qmlscandir):
+    for qml_module in find_qml_modules(args.qtdir, tuple(args.qmlscandir)):
         all_qml_modules.add(qml_module)
 
-        for lib in find_qml_module_libs(args.qtdir, qml_module):
-            all_libs.add(lib)
+        if qml_module.lib:
+            lib_dep_paths.append(qml_module.lib.path)
+
+for lib in find_qt_libs(args.qtdir, list(dict.fromkeys(lib_dep_paths))):
+    all_libs.setdefault(lib.name, lib)
+
+patchelf_multi_file = False
+
+if not op_mode.dry_run:
+    if not shutil.which('patchelf'):
+        log_fatal("cannot find 'patchelf' tool in PATH")
+
+    patchelf_multi_file = patchelf_version() >= (0, 10)
 
 log_normal('Deploying files ...')
 
@@ -539,42 +853,40 @@ if not args.no_conf:
     deploy_qt_conf(dirs)
 
 if not args.no_exe:
-    for exe in sorted(all_executables):
+    for exe in sorted(all_executables.values()):
         deploy_exe(dirs, exe)
 
 if not args.no_lib:
-    for lib in sorted(all_libs):
-        deploy_lib(dirs, lib)
+    deploy_parallel(deploy_lib, dirs, all_libs.values(),
+                    lambda lib: lib.name)
 
 if not args.no_plugins:
-    for plugin in sorted(all_qt_plugins):
-        deploy_qt_plugin(dirs, plugin)
+    deploy_parallel(deploy_qt_plugin, dirs, all_qt_plugins,
+                    lambda plugin: plugin.name)
 
 if not args.no_qml:
-    for qml_module in sorted(all_qml_modules):
-        deploy_qml_module(dirs, qml_module)
+    deploy_parallel(deploy_qml_module, dirs, all_qml_modules,
+                    lambda qml_module: qml_module.relative_path.split(os.sep)[0])
 
 if not args.no_data:
     deploy_resources(dirs, args.qtdir)
 
 if not args.no_translations:
-    for tr in sorted(all_qt_translations):
-        deploy_qt_translation(dirs, tr)
+    deploy_parallel(deploy_qt_translation, dirs, all_qt_translations,
+                    lambda tr: tr.name)
 
 if not args.no_exe:
     log_normal('Updating executables run paths ...')
 
-    for exe in sorted(all_executables):
-        update_deployed_runpath(
-            dirs,
-            os.path.join(dirs.exe_dir, exe.name))
+    update_deployed_runpath(
+        dirs,
+        [os.path.join(dirs.exe_dir, exe.name) for exe in sorted(all_executables.values())])
 
 if not args.no_lib or not args.no_plugins or not ars.no_qml:
     log_normal('Updating libraries run paths ...')
 
-    for lib in sorted(find_libs(dirs.lib_dir, dirs.plugins_dir, dirs.qml_dir)):
-        update_deployed_runpath(
-            dirs,
-            lib.path)
+    update_deployed_runpath(
+        dirs,
+        [lib.path for lib in sorted(find_libs(dirs.lib_dir, dirs.plugins_dir, dirs.qml_dir))])
 
 log_normal('Deployment succeeded.')